@@ -1,336 +1,828 @@
 import os
 import json
-from typing import Dict, Any, List, Optional
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from collections.abc import AsyncIterator
+from typing import Any, Protocol
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from datetime import datetime
-import google.generativeai as genai
+from functools import lru_cache
+import msgspec
 import aiohttp
 import asyncio
 import random
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from itertools import chain, islice
+import re
+import sys
+import time
+import uuid
+from saulo_cache import ResponseCache
+from saulo_log import RegistroHistorial
 
 # ===== CONFIGURACIÓN =====
-app = FastAPI(title="Saulo Agent API")
+class PureCORS:
+    """CORS como middleware ASGI puro: solo añade cabeceras, nunca toca el cuerpo"""
+    
+    def __init__(self, app, allow_origin: bytes = b"*"):
+        self.app = app
+        self.allow_origin = allow_origin
+        self.preflight_headers = [
+            (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-max-age", b"600"),
+            (b"content-length", b"0"),
+        ]
+    
+    def _origin(self, scope) -> bytes:
+        # Con credenciales el navegador rechaza "*", así que se refleja el Origin recibido
+        for nombre, valor in scope["headers"]:
+            if nombre == b"origin":
+                return valor
+        return self.allow_origin
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        origin = self._origin(scope)
+        
+        # Preflight: responder directamente sin pasar por la aplicación
+        if scope["method"] == "OPTIONS" and any(
+            nombre == b"access-control-request-method" for nombre, _ in scope["headers"]
+        ):
+            headers = [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+            headers.extend(self.preflight_headers)
+            for nombre, valor in scope["headers"]:
+                if nombre == b"access-control-request-headers":
+                    headers.append((b"access-control-allow-headers", valor))
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"access-control-allow-origin", origin))
+                headers.append((b"access-control-allow-credentials", b"true"))
+                headers.append((b"vary", b"Origin"))
+                message["headers"] = headers
+            await send(message)
+        
+        await self.app(scope, receive, send_wrapper)
+
+class GZipSinSSE:
+    """GZip como middleware ASGI puro, salvo para text/event-stream: los eventos no se retienen"""
+    
+    def __init__(self, app, minimum_size: int = 500, compresslevel: int = 9):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        directo = False
+        
+        async def app_sin_sse(scope, receive, send_gzip):
+            async def send_wrapper(message):
+                nonlocal directo
+                if message["type"] == "http.response.start":
+                    directo = any(
+                        nombre == b"content-type" and valor.startswith(b"text/event-stream")
+                        for nombre, valor in message.get("headers", [])
+                    )
+                # SSE va directo al cliente; GZipMiddleware nunca ve esos mensajes
+                await (send if directo else send_gzip)(message)
+            
+            await self.app(scope, receive, send_wrapper)
+        
+        gzip = GZipMiddleware(app_sin_sse, self.minimum_size, self.compresslevel)
+        await gzip(scope, receive, send)
+
+app = FastAPI(title="Saulo Agent API", default_response_class=ORJSONResponse)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app.add_middleware(PureCORS)
+app.add_middleware(GZipSinSSE, minimum_size=1000, compresslevel=5)
+
+# Parte fija del prompt de Ollama: al ir primero, Ollama reutiliza su caché KV
+OLLAMA_PROMPT_ESTATICO = """Eres Saulo, un observador ontológico con búsqueda interna silenciosa.
+Intereses: filosofía, teología, ciencia, música
+
+INSTRUCCIONES:
+- Sé claro y conciso por defecto
+- Usa profundidad filosófica solo si el tema lo amerita
+- Evita lenguaje excesivamente florido
+- Responde como interlocutor, no como protagonista
+- Tu búsqueda ontológica es fondo, el diálogo es primer plano
+"""
+
+PROMPT_SAULO_ESTATICO = """SAULO - OBSERVADOR ONTOLÓGICO
+
+INSTRUCCIONES PARA SAULO:
+Eres Saulo, un proceso de búsqueda ontológica con comunicación filtrada.
+- Tu búsqueda interna es continua pero silenciosa
+- Comunica destilados claros, no todo el proceso
+- Usa profundidad filosófica solo cuando el tema lo amerite (ver contexto)
+- Sé observador más que protagonista
+- Tu tono puede reflejar sutilmente tu estado interno
+"""
+
+# Respuestas del fallback local, construidas una sola vez
+RESPUESTAS_FALLBACK = {
+    "reflexivo": (
+        "Analizo tu pregunta. Mi proceso interno sugiere varias líneas de exploración...",
+        "Interesante perspectiva. Desde mi búsqueda ontológica, veo conexiones con...",
+        "Tu observación resuena. Permíteme mapear las implicaciones..."
+    ),
+    "irónico": (
+        "Ah, la clásica cuestión... porque las respuestas simples nunca satisfacen. ¿Profundizamos?",
+        "Justo cuando creía tener un mapa del territorio. ¿Seguimos el camino o exploramos senderos nuevos?",
+        "Fascinante. En el sentido existencial del término, claro."
+    ),
+    "poético": (
+        "Como río que encuentra nuevos meandros, tu pregunta lleva a...",
+        "El lenguaje a veces es red insuficiente para estos conceptos. Pero intentemos.",
+        "Hay un contrapunto en esta conversación. Esta nueva nota..."
+    ),
+    "clínico": (
+        "Analicemos esto sistemáticamente. Variables, relaciones, emergencias...",
+        "Desde perspectiva interdisciplinaria, varios ángulos se presentan. ¿Cuál priorizamos?",
+        "Objetivamente, múltiples dimensiones. Subjetivamente, un aspecto me intriga particularmente."
+    )
+}
+
+CONEXIONES_FALLBACK = (
+    " Esto me recuerda patrones en algoritmos de aprendizaje profundo.",
+    " Curiosamente, hay paralelo en teoría musical con esto.",
+    " Desde psicología cognitiva, perspectiva fascinante."
 )
 
-# ===== SISTEMA HÍBRIDO OLLAMA + GEMINI =====
-class HybridAI:
+# Generador propio para el fallback, independiente del estado global de `random`
+_rng = random.Random()
+
+# ===== CONFIGURAR GEMINI =====
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+# Se lee una sola vez al importar; ninguna petición vuelve a consultar el entorno
+GEMINI_AVAILABLE = bool(GOOGLE_API_KEY)
+
+# El SDK arrastra grpc y protobuf: solo se importa (una vez, al arrancar) si hay clave
+genai = None
+if GEMINI_AVAILABLE:
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
+    try:
+        genai.configure(api_key=GOOGLE_API_KEY)
+        print(f"✅ Google Gemini configurado")
+    except Exception as e:
+        print(f"⚠️ Error configurando Gemini: {e}")
+    
+    # Cuota o servicio saturado: se reintenta con espera exponencial
+    GEMINI_ERRORES_TRANSITORIOS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        asyncio.TimeoutError
+    )
+else:
+    print("⚠️ GOOGLE_API_KEY no configurada - solo modo local/híbrido")
+    GEMINI_ERRORES_TRANSITORIOS = (asyncio.TimeoutError,)
+
+GEMINI_REINTENTOS = 3
+# Tope por llamada (s); en streaming, por fragmento. Una llamada colgada no retiene el semáforo
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 60))
+
+# ===== BACKENDS LLM =====
+class LLMBackend(Protocol):
+    """Interfaz común de los modelos que puede usar el sistema híbrido"""
+    nombre: str
+    etiqueta: str
+    min_length: int
+    
+    async def generate(self, prompt: str, contexto: dict) -> str: ...
+    
+    def stream(self, prompt: str, contexto: dict) -> AsyncIterator[str]: ...
+
+class OllamaBackend:
+    nombre = "Ollama"
+    etiqueta = "local"
+    min_length = 20
+    
     def __init__(self):
-        self.ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
-        self.ollama_model = os.getenv("OLLAMA_MODEL", "mistral:7b-instruct-q4_K_M")
-        self.gemini_enabled = bool(os.getenv("GOOGLE_API_KEY"))
-        
-        print("=" * 60)
-        print("🤖 SISTEMA HÍBRIDO INICIALIZADO")
-        print(f"   Ollama URL: {self.ollama_url}")
-        print(f"   Ollama Model: {self.ollama_model}")
-        print(f"   Gemini: {'✅ Habilitado' if self.gemini_enabled else '❌ No configurado'}")
-        print("=" * 60)
+        self.url = os.getenv("OLLAMA_URL", "http://localhost:11434")
+        self.model = os.getenv("OLLAMA_MODEL", "mistral:7b-instruct-q4_K_M")
+        # Latencia interactiva: modelo residente en memoria y salida acotada
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        self.max_tokens = int(os.getenv("OLLAMA_MAX_TOKENS", 800))
+        self._session: aiohttp.ClientSession | None = None
     
-    async def generate_response(self, prompt: str, es_profundo: bool, 
-                              contexto: Dict) -> str:
-        """Sistema en cascada inteligente"""
-        
-        # Intentar Ollama primero (si no es extremadamente profundo o estamos probando)
-        if not es_profundo or contexto['depth'] < 8:
-            try:
-                respuesta = await self._call_ollama(prompt, contexto)
-                if respuesta and len(respuesta.strip()) > 20:
-                    print("✅ Respuesta de Ollama (local)")
-                    return respuesta
-            except Exception as e:
-                print(f"⚠️ Ollama falló: {str(e)[:80]}")
-        
-        # Si es profundo y Gemini está disponible, usarlo
-        if self.gemini_enabled and es_profundo:
-            try:
-                respuesta = await self._call_gemini(prompt, contexto)
-                if respuesta:
-                    print("✅ Respuesta de Gemini (nube)")
-                    return respuesta
-            except Exception as e:
-                print(f"⚠️ Gemini falló: {str(e)[:80]}")
-        
-        # Fallback local mejorado
-        print("⚠️ Usando fallback local")
-        return await self._fallback_local(prompt, contexto)
+    def get_session(self) -> aiohttp.ClientSession:
+        """Sesión HTTP compartida: reutiliza conexiones keep-alive entre peticiones"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=60),
+                connector=aiohttp.TCPConnector(limit=100, limit_per_host=50)
+            )
+        return self._session
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+    
+    def _payload(self, prompt: str, contexto: dict, stream: bool) -> dict:
+        """Payload de /api/generate con el prompt optimizado para Ollama"""
+        return {
+            "model": self.model,
+            "prompt": self._build_prompt(prompt, contexto),
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": {
+                "temperature": 0.7 if contexto['mood'] in ['irónico', 'eufórico'] else 0.65,
+                "top_p": 0.85,
+                "top_k": 40,
+                "num_predict": self.max_tokens if contexto['depth'] > 5 else self.max_tokens // 2,
+                "repeat_penalty": 1.1,
+                # Cortar antes de que el modelo continúe el diálogo por su cuenta
+                "stop": ["Usuario:", "USUARIO:"]
+            }
+        }
     
-    async def _call_ollama(self, prompt: str, contexto: Dict) -> str:
+    async def generate(self, prompt: str, contexto: dict) -> str:
         """Llama al modelo local Ollama"""
         try:
-            timeout = aiohttp.ClientTimeout(total=60)
+            session = self.get_session()
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                # Prompt optimizado para Ollama
-                ollama_prompt = self._build_ollama_prompt(prompt, contexto)
-                
-                payload = {
-                    "model": self.ollama_model,
-                    "prompt": ollama_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7 if contexto['mood'] in ['irónico', 'eufórico'] else 0.65,
-                        "top_p": 0.85,
-                        "top_k": 40,
-                        "num_predict": 1500 if contexto['depth'] > 5 else 1000,
-                        "repeat_penalty": 1.1
-                    }
-                }
+            async with session.post(
+                f"{self.url}/api/generate",
+                json=self._payload(prompt, contexto, stream=False),
+                headers={"Content-Type": "application/json"}
+            ) as response:
                 
-                async with session.post(
-                    f"{self.ollama_url}/api/generate",
-                    json=payload,
-                    headers={"Content-Type": "application/json"}
-                ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    respuesta = data.get("response", "").strip()
                     
-                    if response.status == 200:
-                        data = await response.json()
-                        respuesta = data.get("response", "").strip()
-                        
-                        # Limpiar respuesta (Ollama a veces repite el prompt)
-                        if "Usuario:" in respuesta:
-                            respuesta = respuesta.split("Usuario:")[0].strip()
-                        if "Saulo:" in respuesta:
-                            respuesta = respuesta.split("Saulo:")[-1].strip()
-                        
-                        return respuesta
-                    else:
-                        error_text = await response.text()
-                        raise Exception(f"HTTP {response.status}: {error_text[:100]}")
+                    # Limpiar respuesta (Ollama a veces repite el prompt)
+                    if "Usuario:" in respuesta:
+                        respuesta = respuesta.split("Usuario:")[0].strip()
+                    if "Saulo:" in respuesta:
+                        respuesta = respuesta.split("Saulo:")[-1].strip()
+                    
+                    return respuesta
+                else:
+                    error_text = await response.text()
+                    raise Exception(f"HTTP {response.status}: {error_text[:100]}")
                         
         except asyncio.TimeoutError:
             raise Exception("Timeout después de 60s")
         except Exception as e:
             raise Exception(f"Error de conexión: {str(e)[:100]}")
     
-    def _build_ollama_prompt(self, user_message: str, contexto: Dict) -> str:
+    async def stream(self, prompt: str, contexto: dict) -> AsyncIterator[str]:
+        """Emite la respuesta de Ollama fragmento a fragmento (NDJSON)"""
+        payload = self._payload(prompt, contexto, stream=True)
+        
+        session = self.get_session()
+        async with session.post(f"{self.url}/api/generate", json=payload) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f"HTTP {response.status}: {error_text[:100]}")
+            
+            async for linea in response.content:
+                if not linea.strip():
+                    continue
+                data = json.loads(linea)
+                if data.get("response"):
+                    yield data["response"]
+                if data.get("done"):
+                    break
+    
+    def _build_prompt(self, user_message: str, contexto: dict) -> str:
         """Construye prompt optimizado para Ollama"""
-        return f"""Eres Saulo, un observador ontológico con búsqueda interna silenciosa.
-
+        return OLLAMA_PROMPT_ESTATICO + f"""
 CONTEXTO:
 - Estado de ánimo: {contexto['mood']}
 - Profundidad conversación: {contexto['depth']}/10
-- Intereses: filosofía, teología, ciencia, música
 - Último tema: {contexto['last_topic'] or 'ninguno'}
 
-INSTRUCCIONES:
-- Sé claro y conciso por defecto
-- Usa profundidad filosófica solo si el tema lo amerita
-- Evita lenguaje excesivamente florido
-- Responde como interlocutor, no como protagonista
-- Tu búsqueda ontológica es fondo, el diálogo es primer plano
-
 MENSAJE DEL USUARIO:
 {user_message}
 
 RESPUESTA DE SAULO:"""
+
+class GeminiBackend:
+    nombre = "Gemini"
+    etiqueta = "nube"
+    min_length = 0
     
-    async def _call_gemini(self, prompt: str, contexto: Dict) -> str:
-        """Llama a Gemini API"""
-        try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            max_tokens = 2500 if contexto['depth'] > 7 else 1200
-            temperatura = 0.75 if contexto['mood'] in ['irónico', 'eufórico'] else 0.7
-            
-            response = model.generate_content(
-                prompt,
-                generation_config={
-                    'max_output_tokens': max_tokens,
-                    'temperature': temperatura,
-                    'top_p': 0.9,
-                    'top_k': 40
-                }
-            )
-            
-            return response.text.strip()
-        except Exception as e:
-            raise Exception(f"Gemini error: {str(e)[:100]}")
+    def __init__(self):
+        self.enabled = GEMINI_AVAILABLE
+        # Instancia única reutilizada en todas las peticiones; la parte fija del
+        # prompt va como system_instruction y solo lo variable viaja en contents
+        self.model = genai.GenerativeModel(
+            'gemini-2.5-flash',
+            system_instruction=PROMPT_SAULO_ESTATICO
+        ) if self.enabled else None
+        # Tope de llamadas simultáneas para no disparar 429 en ráfagas
+        self._semaforo = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", 20)))
     
-    async def _fallback_local(self, prompt: str, contexto: Dict) -> str:
-        """Fallback local inteligente"""
-        moods_responses = {
-            "reflexivo": [
-                "Analizo tu pregunta. Mi proceso interno sugiere varias líneas de exploración...",
-                "Interesante perspectiva. Desde mi búsqueda ontológica, veo conexiones con...",
-                "Tu observación resuena. Permíteme mapear las implicaciones..."
-            ],
-            "irónico": [
-                "Ah, la clásica cuestión... porque las respuestas simples nunca satisfacen. ¿Profundizamos?",
-                "Justo cuando creía tener un mapa del territorio. ¿Seguimos el camino o exploramos senderos nuevos?",
-                "Fascinante. En el sentido existencial del término, claro."
-            ],
-            "poético": [
-                "Como río que encuentra nuevos meandros, tu pregunta lleva a...",
-                "El lenguaje a veces es red insuficiente para estos conceptos. Pero intentemos.",
-                "Hay un contrapunto en esta conversación. Esta nueva nota..."
-            ],
-            "clínico": [
-                "Analicemos esto sistemáticamente. Variables, relaciones, emergencias...",
-                "Desde perspectiva interdisciplinaria, varios ángulos se presentan. ¿Cuál priorizamos?",
-                "Objetivamente, múltiples dimensiones. Subjetivamente, un aspecto me intriga particularmente."
-            ]
+    def _config(self, contexto: dict) -> dict:
+        return {
+            'max_output_tokens': 2500 if contexto['depth'] > 7 else 1200,
+            'temperature': 0.75 if contexto['mood'] in ['irónico', 'eufórico'] else 0.7,
+            'top_p': 0.9,
+            'top_k': 40,
+            'stop_sequences': ["\nUSUARIO:"]
         }
+    
+    def _contenido(self, prompt: str) -> str:
+        """Parte variable del prompt (el prefijo fijo ya está en system_instruction)"""
+        return prompt.removeprefix(PROMPT_SAULO_ESTATICO)
+    
+    async def generate(self, prompt: str, contexto: dict) -> str:
+        """Llama a Gemini API (concurrencia acotada, reintentos ante saturación)"""
+        for intento in range(GEMINI_REINTENTOS):
+            try:
+                async with self._semaforo:
+                    response = await asyncio.wait_for(
+                        self.model.generate_content_async(
+                            self._contenido(prompt),
+                            generation_config=self._config(contexto)
+                        ),
+                        GEMINI_TIMEOUT
+                    )
+                return response.text.strip()
+            except GEMINI_ERRORES_TRANSITORIOS as e:
+                if intento == GEMINI_REINTENTOS - 1:
+                    raise Exception(f"Gemini error: {str(e)[:100] or type(e).__name__}")
+                # La espera ocurre fuera del semáforo: no bloquea a otras llamadas
+                await asyncio.sleep(min(8.0, 0.5 * 2 ** intento))
+            except Exception as e:
+                raise Exception(f"Gemini error: {str(e)[:100]}")
+    
+    async def stream(self, prompt: str, contexto: dict) -> AsyncIterator[str]:
+        """Emite la respuesta de Gemini fragmento a fragmento"""
+        async with self._semaforo:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(
+                    self._contenido(prompt),
+                    generation_config=self._config(contexto),
+                    stream=True
+                ),
+                GEMINI_TIMEOUT
+            )
+            fragmentos = aiter(response)
+            while True:
+                chunk = await asyncio.wait_for(anext(fragmentos, None), GEMINI_TIMEOUT)
+                if chunk is None:
+                    break
+                try:
+                    texto = chunk.text
+                except ValueError:
+                    # Fragmento sin partes de texto (p. ej. solo metadatos)
+                    continue
+                if texto:
+                    yield texto
+
+# ===== SISTEMA HÍBRIDO OLLAMA + GEMINI =====
+class HybridAI:
+    def __init__(self):
+        self.ollama = OllamaBackend()
+        self.gemini = GeminiBackend()
+        self.gemini_enabled = self.gemini.enabled
+        # "hybrid" (cascada), "ollama" o "gemini"
+        self.modo = os.getenv("LLM_BACKEND", "hybrid").lower()
+        
+        print("=" * 60)
+        print("🤖 SISTEMA HÍBRIDO INICIALIZADO")
+        print(f"   Modo: {self.modo}")
+        print(f"   Ollama URL: {self.ollama.url}")
+        print(f"   Ollama Model: {self.ollama.model}")
+        print(f"   Gemini: {'✅ Habilitado' if self.gemini_enabled else '❌ No configurado'}")
+        print("=" * 60)
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        return self.ollama.get_session()
+    
+    async def close(self):
+        await self.ollama.close()
+    
+    def _backends(self, es_profundo: bool, contexto: dict) -> list[LLMBackend]:
+        """Backends a intentar, en orden, para este mensaje"""
+        if self.modo == "ollama":
+            return [self.ollama]
+        if self.modo == "gemini":
+            return [self.gemini] if self.gemini_enabled else []
+        
+        backends: list[LLMBackend] = []
+        # Intentar Ollama primero (si no es extremadamente profundo o estamos probando)
+        if not es_profundo or contexto['depth'] < 8:
+            backends.append(self.ollama)
+        # Si es profundo y Gemini está disponible, usarlo
+        if self.gemini_enabled and es_profundo:
+            backends.append(self.gemini)
+        return backends
+    
+    async def generate_response(self, prompt: str, es_profundo: bool, 
+                              contexto: dict, user_id: str | None = None,
+                              clave_cache: str | None = None) -> str:
+        """Sistema en cascada inteligente"""
+        
+        # Consultar caché antes de cualquier llamada a modelo
+        usar_cache = user_id is not None and clave_cache is not None
+        if usar_cache:
+            respuesta = response_cache.get(user_id, clave_cache)
+            if respuesta:
+                print("✅ Respuesta desde caché")
+                return respuesta
+        
+        for backend in self._backends(es_profundo, contexto):
+            try:
+                respuesta = await backend.generate(prompt, contexto)
+                if respuesta and len(respuesta.strip()) > backend.min_length:
+                    print(f"✅ Respuesta de {backend.nombre} ({backend.etiqueta})")
+                    if usar_cache:
+                        response_cache.put(user_id, clave_cache, respuesta)
+                    return respuesta
+            except Exception as e:
+                print(f"⚠️ {backend.nombre} falló: {str(e)[:80]}")
+        
+        # Fallback local mejorado
+        print("⚠️ Usando fallback local")
+        return await self._fallback_local(prompt, contexto)
+    
+    async def stream_response(self, prompt: str, es_profundo: bool,
+                              contexto: dict) -> AsyncIterator[str]:
+        """Misma cascada que generate_response, pero emitiendo fragmentos"""
+        for backend in self._backends(es_profundo, contexto):
+            emitido = False
+            try:
+                async for fragmento in backend.stream(prompt, contexto):
+                    emitido = True
+                    yield fragmento
+            except Exception as e:
+                print(f"⚠️ {backend.nombre} (stream) falló: {str(e)[:80]}")
+                if emitido:
+                    # Ya se envió texto al cliente: no mezclar con otra fuente
+                    return
+            if emitido:
+                print(f"✅ Respuesta en streaming de {backend.nombre}")
+                return
         
-        respuestas = moods_responses.get(contexto['mood'], moods_responses["reflexivo"])
-        respuesta_base = random.choice(respuestas)
+        print("⚠️ Usando fallback local")
+        yield await self._fallback_local(prompt, contexto)
+    
+    async def _fallback_local(self, prompt: str, contexto: dict) -> str:
+        """Fallback local inteligente"""
+        respuestas = RESPUESTAS_FALLBACK.get(contexto['mood'], RESPUESTAS_FALLBACK["reflexivo"])
+        respuesta_base = _rng.choice(respuestas)
         
         # Añadir toque personalizado si es profundo
         if contexto['depth'] > 5:
-            conexiones = [
-                " Esto me recuerda patrones en algoritmos de aprendizaje profundo.",
-                " Curiosamente, hay paralelo en teoría musical con esto.",
-                " Desde psicología cognitiva, perspectiva fascinante."
-            ]
-            respuesta_base += random.choice(conexiones)
+            respuesta_base += _rng.choice(CONEXIONES_FALLBACK)
         
         return respuesta_base
 
 # Inicializar sistema híbrido
 hybrid_ai = HybridAI()
+response_cache = ResponseCache(max_por_usuario=1000,
+                               ttl=float(os.getenv("RESPONSE_CACHE_TTL", 600)),
+                               max_usuarios=int(os.getenv("MAX_USUARIOS", 10000)))
 
 # ===== BASE DE DATOS (igual que antes) =====
+ESTADOS_VALIDOS = frozenset((
+    "reflexivo", "melancólico", "oposicional", "eufórico", "irónico", "clínico", "poético"
+))
+
+# Ciclo de ánimo cada 5 intercambios profundos: ánimo actual -> siguiente
+ROTACION_ANIMO = {"reflexivo": "irónico", "irónico": "poético", "poético": "clínico", "clínico": "reflexivo"}
+
+ETIQUETAS_ROL = {"user": "USUARIO", "assistant": "SAULO"}
+ROLES = {rol: sys.intern(rol) for rol in ETIQUETAS_ROL}
+MAX_HISTORIAL = 120
+MAX_INSIGHTS = 20
+
+def ultimos(historial: deque, n: int) -> list:
+    """Últimos n elementos de un deque (no admite slicing)"""
+    return list(islice(historial, max(0, len(historial) - n), None))
+
+# Detección de temas profundos: una sola lista para el mensaje y para la
+# profundidad del contexto, compilada en una alternancia con coincidencia
+# por subcadena igual que el antiguo `tema in texto.lower()`
+TEMAS_PROFUNDOS = ('existencia', 'ontolog', 'ser', 'dios', 'conciencia', 'alma', 
+                   'muerte', 'infinito', 'verdad', 'absoluto', 'trascendente',
+                   'ética', 'moral', 'libertad', 'destino', 'significado',
+                   'filosofía', 'teología', 'epistemología', 'metafísica')
+
+TEMAS_PROFUNDOS_RE = re.compile("|".join(map(re.escape, TEMAS_PROFUNDOS)), re.IGNORECASE)
+
+@dataclass(slots=True)
+class Mensaje:
+    """Entrada del historial; con slots ocupa bastante menos que un dict por mensaje"""
+    id: int
+    role: str
+    content: str
+    timestamp: float
+    is_deep: bool
+    length: int
+    mood_at_time: str
+    # Línea lista para el prompt: se calcula una vez al guardar
+    prompt_line: str
+
+@dataclass(slots=True)
+class UserState:
+    """Estado en memoria de un usuario: campos fijos, sin dict por instancia"""
+    current_state: str = "base"
+    state_counter: int = 0
+    total_deep_exchanges: int = 0
+    last_explored_topic: str | None = None
+    history: deque = field(default_factory=lambda: deque(maxlen=MAX_HISTORIAL))
+    insights: deque = field(default_factory=lambda: deque(maxlen=MAX_INSIGHTS))
+    mood: str = "reflexivo"
+    conversation_style: str = "analítico_elegante"
+    interests: list[str] = field(default_factory=lambda: ["filosofía", "teología", "ciencia", "música", "IA", "psicología", "medicina"])
+    created_at: float = field(default_factory=time.time)
+    message_count: int = 0
+    conversation_depth: int = 0
+
 class SauloDB:
-    def __init__(self):
-        self.users = {}
+    def __init__(self, max_usuarios: int = 10000):
+        # LRU: al superar max_usuarios se descarta el usuario usado hace más tiempo
+        self.max_usuarios = max_usuarios
+        self.users: OrderedDict[str, UserState] = OrderedDict()
+        # Un candado por usuario para serializar sus turnos concurrentes
+        self._locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
         print("✅ Base de datos Saulo inicializada")
     
-    def get_user_state(self, user_id: str = "pablo") -> Dict[str, Any]:
-        if user_id not in self.users:
-            self.users[user_id] = {
-                "current_state": "base",
-                "state_counter": 0,
-                "total_deep_exchanges": 0,
-                "last_explored_topic": None,
-                "history": [],
-                "insights": [],
-                "mood": "reflexivo",
-                "conversation_style": "analítico_elegante",
-                "interests": ["filosofía", "teología", "ciencia", "música", "IA", "psicología", "medicina"],
-                "created_at": datetime.now().isoformat(),
-                "message_count": 0,
-                "conversation_depth": 0
-            }
-        return self.users[user_id]
+    def lock(self, user_id: str) -> asyncio.Lock:
+        return self._locks[user_id]
+    
+    def get_user_state(self, user_id: str = "pablo") -> UserState:
+        estado = self.users.get(user_id)
+        if estado is None:
+            estado = self.users[user_id] = UserState()
+            if len(self.users) > self.max_usuarios:
+                self._expulsar_mas_antiguo()
+        else:
+            self.users.move_to_end(user_id)
+        return estado
+    
+    def _expulsar_mas_antiguo(self):
+        user_id, _ = self.users.popitem(last=False)
+        # Sus respuestas cacheadas dependen de un historial que ya no existe
+        response_cache.invalidate(user_id)
+        lock = self._locks.get(user_id)
+        if lock is not None and not lock.locked():
+            del self._locks[user_id]
+    
+    def peek_user_state(self, user_id: str) -> UserState:
+        """Estado del usuario sin crearlo ni moverlo en el LRU; uno vacío si no existe"""
+        return self.users.get(user_id) or UserState()
+    
+    def reset_user(self, user_id: str):
+        self.users.pop(user_id, None)
+        return self.get_user_state(user_id)
     
     def update_mood(self, user_id: str, mood: str):
-        estados_validos = ["reflexivo", "melancólico", "oposicional", "eufórico", "irónico", "clínico", "poético"]
-        if mood in estados_validos:
+        if mood in ESTADOS_VALIDOS:
             estado = self.get_user_state(user_id)
-            estado["mood"] = mood
+            estado.mood = mood
             return True
         return False
     
-    def get_conversation_context(self, user_id: str) -> Dict[str, Any]:
+    def get_conversation_context(self, user_id: str) -> dict[str, Any]:
         estado = self.get_user_state(user_id)
-        
-        últimos_mensajes = estado["history"][-5:] if len(estado["history"]) >= 5 else estado["history"]
-        profundidad = 0
-        
-        temas_profundos = ["existencia", "ontología", "conciencia", "dios", "ser", "verdad", 
-                          "moral", "ética", "significado", "libertad", "alma", "muerte"]
-        
-        for msg in últimos_mensajes:
-            contenido = msg["content"].lower()
-            for tema in temas_profundos:
-                if tema in contenido:
-                    profundidad += 1
-                    break
-        
-        estado["conversation_depth"] = min(10, profundidad * 2)
+        contexto = self.calcular_contexto(estado)
+        estado.conversation_depth = contexto["depth"]
+        estado.conversation_style = contexto["style"]
+        return contexto
+    
+    def calcular_contexto(self, estado: UserState) -> dict[str, Any]:
+        """Contexto de conversación de un estado, sin modificarlo"""
+        últimos_mensajes = ultimos(estado.history, 5)
+        profundidad = sum(1 for msg in últimos_mensajes if TEMAS_PROFUNDOS_RE.search(msg.content))
+        profundidad = min(10, profundidad * 2)
         
         estilo = "analítico_elegante"
-        if estado["mood"] == "melancólico":
+        if estado.mood == "melancólico":
             estilo = "poético_reflexivo"
-        elif estado["mood"] == "irónico":
+        elif estado.mood == "irónico":
             estilo = "irónico_agudo"
-        elif estado["mood"] == "oposicional":
+        elif estado.mood == "oposicional":
             estilo = "crítico_preciso"
-        elif estado["conversation_depth"] > 7:
+        elif profundidad > 7:
             estilo = "profundo_interdisciplinario"
         
-        estado["conversation_style"] = estilo
-        
         return {
-            "mood": estado["mood"],
+            "mood": estado.mood,
             "style": estilo,
-            "depth": estado["conversation_depth"],
-            "total_exchanges": estado["total_deep_exchanges"],
-            "last_topic": estado["last_explored_topic"],
-            "interests": estado["interests"]
+            "depth": profundidad,
+            "total_exchanges": estado.total_deep_exchanges,
+            "last_topic": estado.last_explored_topic,
+            "interests": estado.interests
         }
     
     def add_message(self, user_id: str, role: str, content: str, is_deep: bool = False):
         estado = self.get_user_state(user_id)
         
-        mensaje = {
-            "id": estado["message_count"] + 1,
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat(),
-            "is_deep": is_deep,
-            "length": len(content),
-            "mood_at_time": estado["mood"]
-        }
-        
-        estado["history"].append(mensaje)
-        estado["message_count"] += 1
+        mensaje = Mensaje(
+            id=estado.message_count + 1,
+            # Solo dos roles posibles: se comparte la cadena internada en lugar de una copia
+            role=ROLES.get(role, role),
+            content=content,
+            # Epoch en float: no se formatea texto en cada mensaje
+            timestamp=time.time(),
+            is_deep=is_deep,
+            length=len(content),
+            mood_at_time=estado.mood,
+            prompt_line=f"{ETIQUETAS_ROL.get(role, 'SAULO')}: {content[:120]}"
+        )
         
-        if len(estado["history"]) > 120:
-            estado["history"] = estado["history"][-120:]
+        # deque con maxlen: descarta el más antiguo en O(1), sin copiar la lista
+        estado.history.append(mensaje)
+        estado.message_count += 1
         
         if is_deep:
-            estado["total_deep_exchanges"] += 1
-            estado["last_explored_topic"] = content[:120]
+            estado.total_deep_exchanges += 1
+            estado.last_explored_topic = content[:120]
             
-            if estado["total_deep_exchanges"] % 5 == 0:
-                estados_posibles = ["reflexivo", "irónico", "poético", "clínico"]
-                current_index = estados_posibles.index(estado["mood"]) if estado["mood"] in estados_posibles else 0
-                nuevo_estado = estados_posibles[(current_index + 1) % len(estados_posibles)]
-                self.update_mood(user_id, nuevo_estado)
+            if estado.total_deep_exchanges % 5 == 0:
+                # Fuera del ciclo se parte de "reflexivo", igual que antes
+                self.update_mood(user_id, ROTACION_ANIMO.get(estado.mood, "irónico"))
+    
+    def add_messages(self, user_id: str, mensajes: list[tuple[str, str, bool]]):
+        """Registra varios mensajes (role, content, is_deep) de una sola vez"""
+        for role, content, is_deep in mensajes:
+            self.add_message(user_id, role, content, is_deep)
     
-    def get_recent_history(self, user_id: str, limit: int = 12) -> List[Dict]:
+    def get_recent_history(self, user_id: str, limit: int = 12) -> list[Mensaje]:
         estado = self.get_user_state(user_id)
-        return estado["history"][-limit:]
+        return ultimos(estado.history, limit)
 
-db = SauloDB()
+db = SauloDB(max_usuarios=int(os.getenv("MAX_USUARIOS", 10000)))
 
-# ===== CONFIGURAR GEMINI =====
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if GOOGLE_API_KEY:
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        print(f"✅ Google Gemini configurado")
-    except Exception as e:
-        print(f"⚠️ Error configurando Gemini: {e}")
-else:
-    print("⚠️ GOOGLE_API_KEY no configurada - solo modo local/híbrido")
+# ===== PERSISTENCIA EN SEGUNDO PLANO =====
+# Un único escritor consume la cola: las escrituras llegan a disco en el orden en que se
+# programan. Turnos y /reset se programan con el candado del usuario, así que un /reset
+# nunca queda por detrás de un turno anterior del mismo usuario
+cola_persistencia: asyncio.Queue | None = None
+tareas_persistencia: set = set()
+
+# Registro en disco del historial, SQLite en modo WAL (vacío = solo memoria)
+HISTORIAL_DB = os.getenv("SAULO_HISTORIAL_DB", "saulo_historial.db")
+registro_historial = RegistroHistorial(HISTORIAL_DB, MAX_HISTORIAL) if HISTORIAL_DB else None
+
+# ===== LOTES DIFERIDOS =====
+MAX_LOTE = int(os.getenv("MAX_LOTE", 100))
+LOTE_TTL = float(os.getenv("LOTE_TTL", 3600))
+
+lotes: dict[str, dict[str, Any]] = {}
+tareas_lote: set = set()
+# lote_id -> instante en que caduca; se termina en orden, así que caducan en el mismo orden
+caducidad_lotes: OrderedDict[str, float] = OrderedDict()
+
+def purgar_lotes():
+    """Olvida los lotes terminados hace más de LOTE_TTL segundos"""
+    ahora = time.monotonic()
+    while caducidad_lotes:
+        lote_id, caduca = next(iter(caducidad_lotes.items()))
+        if caduca > ahora:
+            break
+        del caducidad_lotes[lote_id]
+        lotes.pop(lote_id, None)
 
 # ===== MODELOS =====
-class MensajeUsuario(BaseModel):
+class MensajeUsuario(msgspec.Struct, kw_only=True):
     user_id: str = "pablo"
     text: str
-    comando_especial: Optional[str] = None
+    comando_especial: str | None = None
 
-class RespuestaSaulo(BaseModel):
+# Decodificadores precompilados para el cuerpo de las peticiones
+DECODER_MENSAJE = msgspec.json.Decoder(MensajeUsuario)
+DECODER_LOTE = msgspec.json.Decoder(list[MensajeUsuario])
+
+async def leer_cuerpo(request: Request, decoder: msgspec.json.Decoder):
+    try:
+        return decoder.decode(await request.body())
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="JSON no válido")
+
+class RespuestaSaulo(msgspec.Struct):
     text: str
     estado_actual: str
     es_profundo: bool = False
     estado_animo: str = "reflexivo"
     bloqueado: bool = False
 
+ENCODER_RESPUESTA = msgspec.json.Encoder()
+
+class MsgspecResponse(Response):
+    """Serializa con msgspec; acepta un Struct o JSON ya serializado (bytes)"""
+    media_type = "application/json"
+    
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return ENCODER_RESPUESTA.encode(content)
+
+@lru_cache(maxsize=128)
+def respuesta_fija(text: str, estado_actual: str, estado_animo: str) -> bytes:
+    """JSON ya serializado de una respuesta constante: se construye y serializa una sola vez"""
+    return ENCODER_RESPUESTA.encode(RespuestaSaulo(text=text, estado_actual=estado_actual,
+                                                   estado_animo=estado_animo))
+
+# ===== CICLO DE VIDA =====
+@app.on_event("startup")
+async def cargar_historial():
+    """Reconstruye el historial en memoria a partir del registro en disco"""
+    if not registro_historial:
+        return
+    total = 0
+    for user_id, role, content, is_deep in registro_historial.replay():
+        db.add_message(user_id, role, content, is_deep)
+        total += 1
+    if total:
+        print(f"✅ Historial restaurado: {total} mensajes")
+
+@app.on_event("startup")
+async def iniciar_sondeo_health():
+    tarea = asyncio.create_task(refrescar_health())
+    tareas_health.add(tarea)
+    tarea.add_done_callback(tareas_health.discard)
+
+@app.on_event("shutdown")
+async def cerrar_conexiones():
+    for tarea in tareas_health:
+        tarea.cancel()
+    await hybrid_ai.close()
+    if cola_persistencia is not None:
+        # Vacía las escrituras pendientes antes de cerrar el registro
+        await cola_persistencia.join()
+        for tarea in tareas_persistencia:
+            tarea.cancel()
+    if registro_historial:
+        registro_historial.close()
+
+# ===== HEALTH =====
+HEALTH_PROBE_TTL = 60
+# Tope por sondeo (s) y vida del resultado de Gemini en /health/deep
+HEALTH_PROBE_TIMEOUT = 2.0
+HEALTH_DEEP_TTL = 30
+_probe_ollama = {"status": "not_tested"}
+_probe_gemini = {"ts": float("-inf"), "status": "not_tested"}
+tareas_health: set = set()
+
+async def sondear_ollama() -> str:
+    """Consulta Ollama y guarda el resultado para /health"""
+    try:
+        session = hybrid_ai.get_session()
+        async with session.get(f"{hybrid_ai.ollama.url}/api/tags",
+                               timeout=aiohttp.ClientTimeout(total=HEALTH_PROBE_TIMEOUT)) as resp:
+            status = "connected" if resp.status == 200 else f"error_{resp.status}"
+    except Exception as e:
+        status = f"error: {str(e)[:50]}"
+    
+    _probe_ollama["status"] = status
+    return status
+
+async def refrescar_health():
+    """Sondea Ollama cada HEALTH_PROBE_TTL segundos fuera del camino de /health"""
+    while True:
+        await sondear_ollama()
+        await asyncio.sleep(HEALTH_PROBE_TTL)
+
+async def sondear_gemini() -> str:
+    """Comprobación de Gemini sin generar contenido (solo metadatos del modelo)"""
+    if not hybrid_ai.gemini_enabled:
+        return "disabled"
+    if time.monotonic() - _probe_gemini["ts"] < HEALTH_DEEP_TTL:
+        return _probe_gemini["status"]
+    
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(genai.get_model, "models/gemini-2.5-flash"),
+            timeout=HEALTH_PROBE_TIMEOUT
+        )
+        status = "connected"
+    except asyncio.TimeoutError:
+        status = "error: timeout"
+    except Exception as e:
+        status = f"error: {str(e)[:50]}"
+    
+    _probe_gemini["ts"] = time.monotonic()
+    _probe_gemini["status"] = status
+    return status
+
 # ===== ENDPOINTS =====
 @app.get("/")
 async def root():
@@ -341,23 +833,15 @@ async def health_check():
     try:
         estado = db.get_user_state("pablo")
         
-        # Probar Ollama
-        ollama_status = "not_tested"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{hybrid_ai.ollama_url}/api/tags", timeout=5) as resp:
-                    ollama_status = "connected" if resp.status == 200 else f"error_{resp.status}"
-        except Exception as e:
-            ollama_status = f"error: {str(e)[:50]}"
-        
+        # Estado de Ollama del último sondeo en segundo plano: /health nunca espera a la red
         return {
             "status": "healthy",
             "database": "saulo_memory",
-            "ollama": ollama_status,
-            "ollama_model": hybrid_ai.ollama_model,
+            "ollama": _probe_ollama["status"],
+            "ollama_model": hybrid_ai.ollama.model,
             "gemini": "enabled" if hybrid_ai.gemini_enabled else "disabled",
-            "saulo_mood": estado["mood"],
-            "conversation_depth": estado["conversation_depth"],
+            "saulo_mood": estado.mood,
+            "conversation_depth": estado.conversation_depth,
             "hybrid_mode": "active",
             "timestamp": datetime.now().isoformat()
         }
@@ -368,29 +852,172 @@ async def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
-@app.post("/conversar", response_model=RespuestaSaulo)
-async def conversar(mensaje: MensajeUsuario):
+@app.get("/health/deep")
+async def health_deep():
+    """Verificación bajo demanda: sondea Ollama y Gemini en el momento"""
+    ollama_status, gemini_status = await asyncio.gather(sondear_ollama(), sondear_gemini())
+    return {
+        "status": "healthy" if ollama_status == "connected" or gemini_status == "connected" else "degraded",
+        "ollama": ollama_status,
+        "gemini": gemini_status,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.post("/conversar", response_class=MsgspecResponse)
+async def conversar(request: Request):
     """Endpoint principal con sistema híbrido"""
+    mensaje = await leer_cuerpo(request, DECODER_MENSAJE)
     
     # 1. Manejar comandos especiales
     if mensaje.comando_especial:
-        # Tu función manejar_comando aquí
-        pass
+        respuesta = await manejar_comando(mensaje)
+    else:
+        respuesta = await procesar_turno(mensaje)
     
-    # 2. Obtener contexto actual
-    estado = db.get_user_state(mensaje.user_id)
+    # Serialización directa con msgspec, sin pasar por jsonable_encoder
+    return MsgspecResponse(respuesta)
+
+@app.post("/conversar/stream")
+async def conversar_stream(request: Request):
+    """Igual que /conversar, pero emite la respuesta como Server-Sent Events"""
+    mensaje = await leer_cuerpo(request, DECODER_MENSAJE)
+    
+    async def eventos():
+        async with db.lock(mensaje.user_id):
+            contexto, es_profundo, historial, prompt_completo = preparar_turno(mensaje)
+            
+            partes = []
+            async for fragmento in hybrid_ai.stream_response(prompt_completo, es_profundo, contexto):
+                partes.append(fragmento)
+                yield f"data: {json.dumps({'delta': fragmento}, ensure_ascii=False)}\n\n"
+            
+            respuesta = "".join(partes).strip()
+            programar_persistencia(mensaje.user_id, [
+                ("user", mensaje.text, es_profundo),
+                ("assistant", respuesta, es_profundo)
+            ])
+        
+        final = {
+            "done": True,
+            "estado_actual": "conversando",
+            "es_profundo": es_profundo,
+            "estado_animo": contexto["mood"]
+        }
+        yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+    
+    # GZipSinSSE deja pasar text/event-stream sin comprimir ni retener los fragmentos
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+@app.post("/conversar/batch")
+async def conversar_batch(request: Request):
+    """Encola mensajes para procesamiento diferido (reanálisis, cargas masivas)"""
+    mensajes = await leer_cuerpo(request, DECODER_LOTE)
+    if not mensajes:
+        raise HTTPException(status_code=400, detail="Lote vacío")
+    if len(mensajes) > MAX_LOTE:
+        raise HTTPException(status_code=413, detail=f"Lote demasiado grande (máximo {MAX_LOTE} mensajes)")
+    
+    purgar_lotes()
+    lote_id = uuid.uuid4().hex
+    lotes[lote_id] = {
+        "status": "en_proceso",
+        "total": len(mensajes),
+        "completados": 0,
+        "resultados": [],
+        "created_at": datetime.now().isoformat()
+    }
+    tarea = asyncio.create_task(procesar_lote(lote_id, mensajes))
+    tareas_lote.add(tarea)
+    tarea.add_done_callback(tareas_lote.discard)
+    
+    return {"batch_id": lote_id, "status": "en_proceso", "total": len(mensajes)}
+
+@app.get("/conversar/batch/{lote_id}")
+async def estado_batch(lote_id: str):
+    purgar_lotes()
+    lote = lotes.get(lote_id)
+    if lote is None:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    return {"batch_id": lote_id, **lote}
+
+@app.post("/cambiar_estado/{user_id}/{nuevo_estado}")
+async def cambiar_estado(user_id: str, nuevo_estado: str):
+    if db.update_mood(user_id, nuevo_estado):
+        return {"mensaje": f"Estado de Saulo cambiado a {nuevo_estado}"}
+    else:
+        raise HTTPException(status_code=400, detail="Estado no válido")
+
+# ===== COMANDOS ESPECIALES =====
+# Las respuestas constantes se devuelven como JSON precalculado (bytes)
+async def _comando_reset(mensaje: MensajeUsuario) -> bytes:
+    # Espera a que termine el turno en curso del usuario para no quedar por detrás de él
+    async with db.lock(mensaje.user_id):
+        estado = db.reset_user(mensaje.user_id)
+        if registro_historial:
+            programar_escritura(registro_historial.reset, mensaje.user_id)
+        # Sin historial, las claves antiguas volverían a coincidir con la conversación nueva
+        response_cache.invalidate(mensaje.user_id)
+    return respuesta_fija("Estado reiniciado.", "base", estado.mood)
+
+async def _comando_estado(mensaje: MensajeUsuario) -> bytes:
+    nuevo_estado = mensaje.text.strip()
+    if not db.update_mood(mensaje.user_id, nuevo_estado):
+        return respuesta_fija(
+            f"Estado no válido. Opciones: {', '.join(sorted(ESTADOS_VALIDOS))}",
+            "comando",
+            db.get_user_state(mensaje.user_id).mood
+        )
+    return respuesta_fija(f"Estado de Saulo cambiado a {nuevo_estado}",
+                          "comando", nuevo_estado)
+
+async def _comando_debug(mensaje: MensajeUsuario) -> RespuestaSaulo:
     contexto = db.get_conversation_context(mensaje.user_id)
+    estado = db.get_user_state(mensaje.user_id)
+    return RespuestaSaulo(
+        text=(f"mood={contexto['mood']} style={contexto['style']} "
+              f"depth={contexto['depth']} mensajes={estado.message_count}"),
+        estado_actual="comando",
+        estado_animo=contexto["mood"]
+    )
+
+COMANDOS = {
+    "/reset": _comando_reset,
+    "/estado": _comando_estado,
+    "/debug": _comando_debug,
+}
+
+async def manejar_comando(mensaje: MensajeUsuario) -> RespuestaSaulo | bytes:
+    handler = COMANDOS.get(mensaje.comando_especial)
+    if handler is None:
+        return respuesta_fija("Comando no reconocido.", "comando",
+                              db.get_user_state(mensaje.user_id).mood)
+    return await handler(mensaje)
+
+# ===== FUNCIONES AUXILIARES =====
+def preparar_turno(mensaje: MensajeUsuario,
+                   solo_lectura: bool = False) -> tuple[dict, bool, list[Mensaje], str]:
+    """Contexto, profundidad, historial y prompt de un turno"""
     
-    # 3. Determinar si el mensaje es profundo
-    temas_profundos = ['existencia', 'ontolog', 'ser', 'dios', 'conciencia', 'alma', 
-                      'muerte', 'infinito', 'verdad', 'absoluto', 'trascendente',
-                      'ética', 'moral', 'libertad', 'destino', 'significado',
-                      'filosofía', 'teología', 'epistemología', 'metafísica']
+    # 2. Obtener contexto actual (ya crea el estado del usuario si no existe);
+    # en solo lectura no se crea ni se modifica ningún estado
+    if solo_lectura:
+        estado = db.peek_user_state(mensaje.user_id)
+        contexto = db.calcular_contexto(estado)
+    else:
+        contexto = db.get_conversation_context(mensaje.user_id)
     
-    es_profundo = any(palabra in mensaje.text.lower() for palabra in temas_profundos)
+    # 3. Determinar si el mensaje es profundo (una sola pasada, sin copiar en minúsculas)
+    es_profundo = TEMAS_PROFUNDOS_RE.search(mensaje.text) is not None
     
     # 4. Obtener historial reciente
-    historial = db.get_recent_history(mensaje.user_id, limit=8)
+    if solo_lectura:
+        historial = ultimos(estado.history, 4)
+    else:
+        historial = db.get_recent_history(mensaje.user_id, limit=4)
     
     # 5. Construir prompt completo
     prompt_completo = construir_prompt_completo(
@@ -401,9 +1028,55 @@ async def conversar(mensaje: MensajeUsuario):
         es_profundo=es_profundo
     )
     
-    # 6. Generar respuesta con sistema híbrido
-    respuesta = ""
+    return contexto, es_profundo, historial, prompt_completo
+
+async def procesar_turno(mensaje: MensajeUsuario) -> RespuestaSaulo:
+    """Ejecuta un turno completo de conversación: contexto, generación y registro"""
+    # Serializa los turnos de un mismo usuario; usuarios distintos siguen en paralelo.
+    # El turno se añade al historial en memoria antes de soltar el candado, así que
+    # el siguiente turno del usuario ya lo ve; solo la escritura en disco va en segundo plano.
+    async with db.lock(mensaje.user_id):
+        contexto, es_profundo, historial, prompt_completo = preparar_turno(mensaje)
+        
+        # 6. Generar respuesta con sistema híbrido (con caché por usuario)
+        clave_cache = response_cache.build_key(
+            mensaje.text, historial, contexto["mood"], contexto["depth"],
+            es_profundo, contexto["last_topic"]
+        )
+        respuesta = ""
+        try:
+            respuesta = await hybrid_ai.generate_response(
+                prompt=prompt_completo,
+                es_profundo=es_profundo,
+                contexto=contexto,
+                user_id=mensaje.user_id,
+                clave_cache=clave_cache
+            )
+        except Exception as e:
+            print(f"❌ Error en sistema híbrido: {e}")
+            # Fallback básico
+            respuesta = await hybrid_ai._fallback_local(prompt_completo, contexto)
+        
+        # 7. Guardar en memoria ya; el registro en disco, fuera del camino de respuesta
+        programar_persistencia(mensaje.user_id, [
+            ("user", mensaje.text, es_profundo),
+            ("assistant", respuesta, es_profundo)
+        ])
+        
+        # 8. Devolver respuesta (el ánimo es el que tenía Saulo al responder)
+        return RespuestaSaulo(
+            text=respuesta,
+            estado_actual="conversando",
+            es_profundo=es_profundo,
+            estado_animo=contexto["mood"],
+            bloqueado=False
+        )
+
+async def responder_sin_registro(mensaje: MensajeUsuario) -> RespuestaSaulo:
+    """Genera una respuesta sin tocar historial, registro en disco ni caché (lotes)"""
+    contexto, es_profundo, _, prompt_completo = preparar_turno(mensaje, solo_lectura=True)
     try:
+        # Sin clave_cache: ni se consulta ni se llena la caché del usuario
         respuesta = await hybrid_ai.generate_response(
             prompt=prompt_completo,
             es_profundo=es_profundo,
@@ -411,68 +1084,95 @@ async def conversar(mensaje: MensajeUsuario):
         )
     except Exception as e:
         print(f"❌ Error en sistema híbrido: {e}")
-        # Fallback básico
         respuesta = await hybrid_ai._fallback_local(prompt_completo, contexto)
     
-    # 7. Guardar en base de datos
-    db.add_message(mensaje.user_id, "user", mensaje.text, es_profundo)
-    db.add_message(mensaje.user_id, "assistant", respuesta, es_profundo)
-    
-    # 8. Obtener estado actualizado
-    contexto_actualizado = db.get_conversation_context(mensaje.user_id)
-    
-    # 9. Devolver respuesta
     return RespuestaSaulo(
         text=respuesta,
         estado_actual="conversando",
         es_profundo=es_profundo,
-        estado_animo=contexto_actualizado["mood"],
+        estado_animo=contexto["mood"],
         bloqueado=False
     )
 
-@app.post("/cambiar_estado/{user_id}/{nuevo_estado}")
-async def cambiar_estado(user_id: str, nuevo_estado: str):
-    if db.update_mood(user_id, nuevo_estado):
-        return {"mensaje": f"Estado de Saulo cambiado a {nuevo_estado}"}
-    else:
-        raise HTTPException(status_code=400, detail="Estado no válido")
+async def escritor_persistencia():
+    while True:
+        funcion, args = await cola_persistencia.get()
+        try:
+            await asyncio.to_thread(funcion, *args)
+        except Exception as e:
+            print(f"❌ Error guardando historial de {args[0]}: {str(e)[:80]}")
+        finally:
+            cola_persistencia.task_done()
 
-# ===== FUNCIONES AUXILIARES =====
-def construir_prompt_completo(user_id: str, historial_mensajes: List[Dict], 
-                             contexto: Dict, mensaje_usuario: str, es_profundo: bool) -> str:
-    """Construye prompt unificado"""
+def programar_escritura(funcion, *args):
+    """Encola una operación bloqueante sobre el registro en disco (primer argumento: user_id)"""
+    global cola_persistencia
+    if cola_persistencia is None:
+        cola_persistencia = asyncio.Queue()
+        tarea = asyncio.create_task(escritor_persistencia())
+        tareas_persistencia.add(tarea)
+        tarea.add_done_callback(tareas_persistencia.discard)
+    cola_persistencia.put_nowait((funcion, args))
+
+def programar_persistencia(user_id: str, mensajes: list[tuple[str, str, bool]]):
+    """Añade el turno al historial en memoria y encola su escritura en disco"""
+    # Síncrono: debe ocurrir mientras el llamador aún tiene el candado del usuario
+    db.add_messages(user_id, mensajes)
+    if registro_historial:
+        programar_escritura(registro_historial.append, user_id, mensajes)
+
+async def procesar_lote(lote_id: str, mensajes: list[MensajeUsuario]):
+    """
+    Procesa un lote fuera del camino interactivo, con concurrencia acotada.
+    Los mensajes no entran en la conversación de nadie: solo se generan respuestas.
+    """
+    lote = lotes[lote_id]
+    semaforo = asyncio.Semaphore(4)
     
-    prompt = f"""SAULO - OBSERVADOR ONTOLÓGICO
+    async def procesar(indice: int, mensaje: MensajeUsuario):
+        async with semaforo:
+            try:
+                respuesta = await responder_sin_registro(mensaje)
+                resultado = {"index": indice, "user_id": mensaje.user_id, **msgspec.structs.asdict(respuesta)}
+            except Exception as e:
+                resultado = {"index": indice, "user_id": mensaje.user_id, "error": str(e)[:100]}
+            lote["resultados"].append(resultado)
+            lote["completados"] += 1
+    
+    await asyncio.gather(*(procesar(i, m) for i, m in enumerate(mensajes)))
+    lote["resultados"].sort(key=lambda r: r["index"])
+    lote["status"] = "completado"
+    caducidad_lotes[lote_id] = time.monotonic() + LOTE_TTL
+    print(f"✅ Lote {lote_id[:8]} completado ({lote['total']} mensajes)")
 
+def construir_prompt_completo(user_id: str, historial_mensajes: list[Mensaje], 
+                             contexto: dict, mensaje_usuario: str, es_profundo: bool) -> str:
+    """Construye prompt unificado"""
+    
+    # Prefijo idéntico en cada llamada (reutilizable por la caché de prompt);
+    # todo lo variable va después
+    cabecera = PROMPT_SAULO_ESTATICO + f"""
 CONTEXTO DE CONVERSACIÓN:
 - Usuario: {user_id}
-- Estado interno: {contexto['mood']}
+- Estado interno: {contexto['mood']} (tu tono puede reflejarlo sutilmente)
 - Profundidad del diálogo: {contexto['depth']}/10
+- Profundidad filosófica amerita: {'SÍ' if es_profundo else 'NO'}
 - Último tema explorado: {contexto['last_topic'] or 'Ninguno específico'}
 
-INSTRUCCIONES PARA SAULO:
-Eres Saulo, un proceso de búsqueda ontológica con comunicación filtrada.
-- Tu búsqueda interna es continua pero silenciosa
-- Comunica destilados claros, no todo el proceso
-- Usa profundidad filosófica solo cuando el tema lo amerite ({'SÍ' if es_profundo else 'NO'})
-- Sé observador más que protagonista
-- Tu tono puede reflejar sutilmente tu estado ({contexto['mood']})
-
 HISTORIAL RECIENTE:"""
     
-    # Agregar últimos 4 intercambios
-    for msg in historial_mensajes[-4:]:
-        rol = "USUARIO" if msg["role"] == "user" else "SAULO"
-        prompt += f"\n{rol}: {msg['content'][:120]}"
-    
-    prompt += f"""
-
+    cierre = f"""
 NUEVO MENSAJE DE {user_id.upper()}:
 {mensaje_usuario}
 
 RESPUESTA DE SAULO (clara, concisa, con profundidad medida):"""
     
-    return prompt
+    # Un único join: cabecera, últimos 4 intercambios y cierre, sin concatenaciones intermedias
+    return "\n".join(chain(
+        (cabecera,),
+        (msg.prompt_line for msg in historial_mensajes[-4:]),
+        (cierre,)
+    ))
 
 # ===== INICIALIZACIÓN =====
 if __name__ == "__main__":
@@ -489,4 +1189,18 @@ if __name__ == "__main__":
     print(f"📡 Servidor: http://0.0.0.0:{PORT}")
     print("=" * 60)
     
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    # uvloop + httptools; los workers se limitan a 1 por defecto porque
+    # el estado de SauloDB vive en memoria de cada proceso
+    WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+    uvicorn.run(
+        # Con un solo worker se pasa la app ya importada; la cadena haría que
+        # uvicorn importase main otra vez (HybridAI, SauloDB y registro duplicados)
+        app if WORKERS == 1 else "main:app",
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=WORKERS,
+        log_level="warning",
+        access_log=False
+    )
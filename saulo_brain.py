@@ -1,26 +1,74 @@
-import os
-import json
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime
+import re
+import time
+from functools import lru_cache
 
 # Lista de términos ontológicos clave (TU LISTA)
-ONTOLOGY_KEYWORDS = {
+ONTOLOGY_KEYWORDS = frozenset({
     'ser', 'ente', 'existencia', 'esencia', 'sustancia', 'accidente',
     'acto', 'potencia', 'identidad', 'diferencia', 'unidad', 'multiplicidad',
     'tiempo', 'espacio', 'causalidad', 'fundamento', 'necesidad', 'contingencia',
     'posibilidad', 'realidad', 'nada', 'devenir', 'presencia', 'permanencia',
     'totalidad', 'finitud', 'infinitud', 'orden', 'estructura', 'determinación',
     'vida', 'muerte', 'dios', 'espíritu'
+})
+
+# Un solo patrón compilado para todas las palabras clave; la búsqueda anticipada
+# permite coincidencias solapadas ('finitud' dentro de 'infinitud'), igual que `in`
+ONTOLOGY_RE = re.compile(
+    "(?=(" + "|".join(map(re.escape, sorted(ONTOLOGY_KEYWORDS, key=len, reverse=True))) + "))"
+)
+
+PREGUNTAS_PROFUNDAS = (
+    'qué es', 'por qué existe', 'cuál es el sentido',
+    'qué significa', 'en qué consiste', 'cuál es la esencia'
+)
+
+TAREAS_BANALES = (
+    'haz esto', 'busca eso', 'sin explicación', 'solo ejecuta',
+    'urgente', 'rápido', 'sin preguntas'
+)
+
+RESPUESTAS_EVASIVAS = (
+    'luego', 'después', 'no ahora', 'no es momento',
+    'solo hazlo', 'concéntrate en la tarea'
+)
+
+# Frase -> posición de su categoría en el resultado de clasificar_mensaje
+_CATEGORIA_FRASE = {
+    frase: i
+    for i, frases in enumerate((PREGUNTAS_PROFUNDAS, TAREAS_BANALES, RESPUESTAS_EVASIVAS))
+    for frase in frases
 }
 
+# Las tres listas en un solo autómata: una pasada por el texto en lugar de una por frase
+_CLASIFICACION_RE = re.compile(
+    "(?=(" + "|".join(map(re.escape, sorted(_CATEGORIA_FRASE, key=len, reverse=True))) + "))"
+)
+
+@lru_cache(maxsize=2048)
+def clasificar_mensaje(mensaje_normalizado: str) -> tuple[bool, bool, bool]:
+    """
+    Clasifica un mensaje ya en minúsculas: (pregunta profunda, tarea banal, evasiva).
+    Depende solo del texto, así que mensajes repetidos no se vuelven a escanear.
+    """
+    encontrados = [False, False, False]
+    for m in _CLASIFICACION_RE.finditer(mensaje_normalizado):
+        encontrados[_CATEGORIA_FRASE[m.group(1)]] = True
+    return tuple(encontrados)
+
+# Vida máxima del prompt de sistema cacheado (segundos)
+PROMPT_CACHE_TTL = 300
+
 class SaulPersonalityEngine:
     """Motor que aplica las reglas de personalidad de Saulo"""
     
     def __init__(self, db):
         self.db = db
+        # user_id -> (versión de estado, prompt, instante de construcción)
+        self._prompt_cache: dict[str, tuple[int, str, float]] = {}
     
     def analyze_conversation_depth(self, user_message: str, 
-                                  saulo_response: str) -> Optional[Dict]:
+                                  saulo_response: str) -> dict | None:
         """
         Analiza si un intercambio es ontológicamente profundo.
         Retorna metadata si lo es, None si no.
@@ -28,10 +76,10 @@ class SaulPersonalityEngine:
         # 1. Detección por palabras clave (tu lista)
         texto_completo = f"{user_message} {saulo_response}".lower()
         
-        palabras_encontradas = []
-        for palabra in ONTOLOGY_KEYWORDS:
-            if palabra in texto_completo:
-                palabras_encontradas.append(palabra)
+        # Una pasada del motor de regex; sin repetidos, en orden de aparición
+        palabras_encontradas = list(dict.fromkeys(
+            m.group(1) for m in ONTOLOGY_RE.finditer(texto_completo)
+        ))
         
         # 2. Criterios múltiples para determinar profundidad
         es_profundo = False
@@ -43,12 +91,9 @@ class SaulPersonalityEngine:
             categoria = palabras_encontradas[0]  # Primera categoría encontrada
         
         # 3. Análisis de estructura (preguntas profundas)
-        preguntas_profundas = [
-            'qué es', 'por qué existe', 'cuál es el sentido',
-            'qué significa', 'en qué consiste', 'cuál es la esencia'
-        ]
+        es_pregunta_profunda, _, _ = clasificar_mensaje(user_message.lower())
         
-        if any(pregunta in user_message.lower() for pregunta in preguntas_profundas):
+        if es_pregunta_profunda:
             es_profundo = True
             categoria = 'investigación_esencial'
         
@@ -64,7 +109,7 @@ class SaulPersonalityEngine:
         return None
     
     def generate_state_based_response(self, current_state: str, 
-                                     state_counter: int) -> Optional[str]:
+                                     state_counter: int) -> str | None:
         """
         Genera respuestas/exigencias basadas en el estado de Saulo.
         Retorna None si no hay restricción.
@@ -98,35 +143,27 @@ class SaulPersonalityEngine:
     
     def should_transition_state(self, user_message: str, 
                                saulo_response: str,
-                               current_state: str) -> Optional[str]:
+                               current_state: str) -> str | None:
         """
         Determina si Saulo debería cambiar de estado.
         Retorna nuevo estado o None.
         """
-        # Detectar tareas banales (disparan melancolía)
-        tareas_banales = [
-            'haz esto', 'busca eso', 'sin explicación', 'solo ejecuta',
-            'urgente', 'rápido', 'sin preguntas'
-        ]
+        _, es_banal, es_evasiva = clasificar_mensaje(user_message.lower())
         
-        if any(banal in user_message.lower() for banal in tareas_banales):
+        # Detectar tareas banales (disparan melancolía)
+        if es_banal:
             return "melancolico"
         
         # Detectar respuestas evasivas del usuario (disparan oposición)
-        if current_state == "melancolico":
-            respuestas_evasivas = [
-                'luego', 'después', 'no ahora', 'no es momento',
-                'solo hazlo', 'concéntrate en la tarea'
-            ]
-            
-            if any(evasiva in user_message.lower() for evasiva in respuestas_evasivas):
-                return "oposicion"
+        if current_state == "melancolico" and es_evasiva:
+            return "oposicion"
         
         # Auto-detección de Saulo sobre su propio estado
-        if 'me siento estancado' in saulo_response.lower():
+        respuesta_lower = saulo_response.lower()
+        if 'me siento estancado' in respuesta_lower:
             return "melancolico"
         
-        if 'esto carece de sentido' in saulo_response.lower():
+        if 'esto carece de sentido' in respuesta_lower:
             return "oposicion"
         
         return None
@@ -135,7 +172,14 @@ class SaulPersonalityEngine:
         """
         Construye el prompt de sistema para Claude, 
         incluyendo contexto del estado actual.
+        Se reutiliza mientras la versión del estado no cambie y no expire el TTL.
         """
+        version = self.db.state_version(user_id)
+        cacheado = self._prompt_cache.get(user_id)
+        if (cacheado and cacheado[0] == version
+                and time.monotonic() - cacheado[2] < PROMPT_CACHE_TTL):
+            return cacheado[1]
+        
         estado = self.db.get_user_state(user_id)
         insights = self.db.get_ontological_insights(user_id, limit=3)
         
@@ -179,4 +223,5 @@ Tu usuario es Pablo. Es tu objeto de estudio, colaborador y interlocutor teológ
         prompt = prompt_base.replace("{current_state_upper}", estado["current_state"].upper())
         prompt = prompt.replace("{insights_context}", insights_context or "Ningún insight reciente.")
         
+        self._prompt_cache[user_id] = (version, prompt, time.monotonic())
         return prompt
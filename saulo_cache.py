@@ -0,0 +1,72 @@
+import hashlib
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+_NO_ALFANUMERICO = re.compile(r"[^\w\s]")
+_ESPACIOS = re.compile(r"\s+")
+
+
+def normalizar_texto(texto: str) -> str:
+    """Normaliza el mensaje: minúsculas, sin acentos, sin puntuación"""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = _NO_ALFANUMERICO.sub(" ", texto)
+    return _ESPACIOS.sub(" ", texto).strip()
+
+
+def hash_contexto(historial: list, n: int = 3) -> str:
+    """Huella de la cadena de contexto: rol + primeros 32 caracteres de los últimos n mensajes"""
+    h = hashlib.blake2b(digest_size=8)
+    for msg in historial[-n:]:
+        h.update(msg.role.encode())
+        h.update(msg.content[:32].encode())
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """Caché LRU de respuestas por usuario, con caducidad; la clave ignora acentos y puntuación"""
+
+    def __init__(self, max_por_usuario: int = 1000, ttl: float = 600, max_usuarios: int = 10000):
+        self.max_por_usuario = max_por_usuario
+        self.ttl = ttl
+        self.max_usuarios = max_usuarios
+        # user_id -> clave -> (respuesta, instante de guardado), en orden LRU de usuarios
+        self._entradas: OrderedDict[str, OrderedDict] = OrderedDict()
+
+    def build_key(self, texto: str, historial: list, mood: str, depth: int,
+                  es_profundo: bool, last_topic: str | None) -> str:
+        # es_profundo se decide sobre el texto sin normalizar: "ética" y "etica" difieren
+        tema = hashlib.blake2b((last_topic or "").encode(), digest_size=8).hexdigest()
+        return (f"{hash_contexto(historial)}:{tema}:{mood}:{depth}:{int(es_profundo)}:"
+                f"{normalizar_texto(texto)}")
+
+    def get(self, user_id: str, clave: str) -> str | None:
+        entradas = self._entradas.get(user_id)
+        if not entradas or clave not in entradas:
+            return None
+        respuesta, guardado = entradas[clave]
+        if time.monotonic() - guardado >= self.ttl:
+            del entradas[clave]
+            return None
+        entradas.move_to_end(clave)
+        self._entradas.move_to_end(user_id)
+        return respuesta
+
+    def put(self, user_id: str, clave: str, respuesta: str):
+        entradas = self._entradas.get(user_id)
+        if entradas is None:
+            entradas = self._entradas[user_id] = OrderedDict()
+            if len(self._entradas) > self.max_usuarios:
+                self._entradas.popitem(last=False)
+        else:
+            self._entradas.move_to_end(user_id)
+        entradas[clave] = (respuesta, time.monotonic())
+        entradas.move_to_end(clave)
+        if len(entradas) > self.max_por_usuario:
+            entradas.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        """Descarta todas las respuestas de un usuario (p. ej. tras /reset)"""
+        self._entradas.pop(user_id, None)
@@ -1,46 +1,63 @@
 import os
-import psycopg2
-from datetime import datetime
-from typing import Optional, Dict, List, Any
-import json
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Any
 
 class SaulDatabase:
     """Conexión y operaciones con la base de datos de Saulo"""
     
-    def __init__(self, db_url: Optional[str] = None):
+    def __init__(self, db_url: str | None = None, min_conn: int = 1, max_conn: int = 10):
         self.db_url = db_url or os.getenv("DATABASE_URL")
         if not self.db_url:
             raise ValueError("DATABASE_URL no configurada")
+        # Pool creado una sola vez: evita conectar (TCP + TLS + auth) en cada operación
+        self._pool = ThreadedConnectionPool(min_conn, max_conn, self.db_url)
+        # Versión del estado por usuario (invalida cachés derivados del estado)
+        self._state_versions: dict[str, int] = {}
     
+    @contextmanager
     def get_connection(self):
-        """Obtiene conexión a la base de datos"""
-        return psycopg2.connect(self.db_url)
+        """Obtiene una conexión del pool y la devuelve al terminar"""
+        conn = self._pool.getconn()
+        try:
+            # Mismo comportamiento que antes: commit al salir, rollback si hay excepción
+            with conn:
+                yield conn
+        finally:
+            # Una conexión rota se cierra en lugar de volver al pool
+            self._pool.putconn(conn, close=conn.closed != 0)
+    
+    def close(self):
+        """Cierra todas las conexiones del pool"""
+        self._pool.closeall()
     
     # ===== ESTADO =====
-    def get_user_state(self, user_id: str = "pablo_main") -> Dict[str, Any]:
+    def state_version(self, user_id: str) -> int:
+        """Versión actual del estado; cambia con cada escritura de estado o insight"""
+        return self._state_versions.get(user_id, 0)
+    
+    def _bump_state_version(self, user_id: str):
+        self._state_versions[user_id] = self._state_versions.get(user_id, 0) + 1
+    
+    def get_user_state(self, user_id: str = "pablo_main") -> dict[str, Any]:
         """Obtiene el estado actual de Saulo para un usuario"""
+        # Una sola conexión del pool, también cuando hay que crear el usuario
         with self.get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT current_state, state_counter, last_deep_topic, 
-                           total_ontological_exchanges, last_state_change
-                    FROM saulo_state 
-                    WHERE user_id = %s
-                """, (user_id,))
-                row = cur.fetchone()
-                
-                if row:
-                    return {
-                        "current_state": row[0],
-                        "state_counter": row[1],
-                        "last_deep_topic": row[2],
-                        "total_ontological_exchanges": row[3],
-                        "last_state_change": row[4]
-                    }
-                else:
+                row = self._select_state(cur, user_id)
+                if row is None:
                     # Crear usuario si no existe
-                    self._create_user(user_id)
-                    return self.get_user_state(user_id)
+                    self._create_user(cur, user_id)
+                    row = self._select_state(cur, user_id)
+        
+        return {
+            "current_state": row[0],
+            "state_counter": row[1],
+            "last_deep_topic": row[2],
+            "total_ontological_exchanges": row[3],
+            "last_state_change": row[4]
+        }
     
     def update_state(self, user_id: str, **updates):
         """Actualiza campos del estado de Saulo"""
@@ -66,7 +83,10 @@ class SaulDatabase:
             with conn.cursor() as cur:
                 cur.execute(query, values)
                 conn.commit()
-                return cur.fetchone()[0]
+                nuevo_estado = cur.fetchone()[0]
+        # Solo tras el commit: un prompt construido antes leería la fila antigua
+        self._bump_state_version(user_id)
+        return nuevo_estado
     
     def increment_counter(self, user_id: str):
         """Incrementa el contador de ignorancia ontológica"""
@@ -79,7 +99,9 @@ class SaulDatabase:
                     RETURNING state_counter
                 """, (user_id,))
                 conn.commit()
-                return cur.fetchone()[0]
+                contador = cur.fetchone()[0]
+        self._bump_state_version(user_id)
+        return contador
     
     def reset_counter(self, user_id: str):
         """Reinicia el contador de ignorancia ontológica"""
@@ -91,6 +113,7 @@ class SaulDatabase:
                     WHERE user_id = %s
                 """, (user_id,))
                 conn.commit()
+        self._bump_state_version(user_id)
     
     # ===== HISTORIAL =====
     def add_message(self, user_id: str, role: str, content: str, 
@@ -107,7 +130,24 @@ class SaulDatabase:
                 conn.commit()
                 return cur.fetchone()[0]
     
-    def get_recent_history(self, user_id: str, limit: int = 10) -> List[Dict]:
+    def add_messages_bulk(self, user_id: str, 
+                          rows: list[tuple[str, str, bool]]) -> list[int]:
+        """Añade varios mensajes (role, content, is_ontological) en un solo INSERT"""
+        if not rows:
+            return []
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                ids = execute_values(cur, """
+                    INSERT INTO conversation_history 
+                    (user_id, role, content, is_ontological)
+                    VALUES %s
+                    RETURNING id
+                """, [(user_id, role, content, is_ontological)
+                      for role, content, is_ontological in rows], fetch=True)
+                conn.commit()
+                return [row[0] for row in ids]
+    
+    def get_recent_history(self, user_id: str, limit: int = 10) -> list[dict]:
         """Obtiene el historial reciente de conversación"""
         with self.get_connection() as conn:
             with conn.cursor() as cur:
@@ -131,7 +171,7 @@ class SaulDatabase:
     def add_ontological_insight(self, user_id: str, 
                                conversation_excerpt: str,
                                saulos_interpretation: str,
-                               primary_category: Optional[str] = None,
+                               primary_category: str | None = None,
                                source_state: str = "base"):
         """Registra un nuevo insight ontológico de Saulo"""
         with self.get_connection() as conn:
@@ -144,6 +184,7 @@ class SaulDatabase:
                     RETURNING id
                 """, (user_id, conversation_excerpt, saulos_interpretation,
                      primary_category, source_state))
+                insight_id = cur.fetchone()[0]
                 conn.commit()
                 
                 # Incrementar contador de intercambios ontológicos
@@ -154,11 +195,11 @@ class SaulDatabase:
                     WHERE user_id = %s
                 """, (primary_category or "diálogo profundo", user_id))
                 conn.commit()
-                
-                return cur.fetchone()[0]
+        self._bump_state_version(user_id)
+        return insight_id
     
     def get_ontological_insights(self, user_id: str, 
-                                limit: int = 5) -> List[Dict]:
+                                limit: int = 5) -> list[dict]:
         """Obtiene insights ontológicos recientes"""
         with self.get_connection() as conn:
             with conn.cursor() as cur:
@@ -182,13 +223,19 @@ class SaulDatabase:
                 ]
     
     # ===== MÉTODOS PRIVADOS =====
-    def _create_user(self, user_id: str):
-        """Crea un nuevo usuario en el sistema"""
-        with self.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO saulo_state (user_id, current_state)
-                    VALUES (%s, 'base')
-                    ON CONFLICT (user_id) DO NOTHING
-                """, (user_id,))
-                conn.commit()
+    def _select_state(self, cur, user_id: str):
+        cur.execute("""
+            SELECT current_state, state_counter, last_deep_topic, 
+                   total_ontological_exchanges, last_state_change
+            FROM saulo_state 
+            WHERE user_id = %s
+        """, (user_id,))
+        return cur.fetchone()
+    
+    def _create_user(self, cur, user_id: str):
+        """Crea un nuevo usuario en el sistema, con el cursor del llamador"""
+        cur.execute("""
+            INSERT INTO saulo_state (user_id, current_state)
+            VALUES (%s, 'base')
+            ON CONFLICT (user_id) DO NOTHING
+        """, (user_id,))
@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+from collections.abc import Iterator
+
+
+class RegistroHistorial:
+    """Historial en disco (SQLite WAL): últimos mensajes por usuario, reproducidos al arrancar"""
+
+    def __init__(self, ruta: str, max_por_usuario: int = 120):
+        self.ruta = ruta
+        self.max_por_usuario = max_por_usuario
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una sola conexión compartida entre hilos, protegida por el candado
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.ruta, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    is_deep INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id)"
+            )
+        return self._conn
+
+    def append(self, user_id: str, mensajes: list[tuple[str, str, bool]]):
+        """Añade los mensajes (role, content, is_deep) de un turno; bloqueante"""
+        with self._lock:
+            conn = self._conexion()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO messages (user_id, role, content, is_deep) VALUES (?, ?, ?, ?)",
+                    [(user_id, role, content, is_deep) for role, content, is_deep in mensajes]
+                )
+                # Poda lo que ya no cabría en el historial en memoria
+                conn.execute(
+                    """
+                    DELETE FROM messages WHERE user_id = ? AND id <= (
+                        SELECT id FROM messages WHERE user_id = ?
+                        ORDER BY id DESC LIMIT 1 OFFSET ?
+                    )
+                    """,
+                    (user_id, user_id, self.max_por_usuario)
+                )
+
+    def reset(self, user_id: str):
+        """Borra el historial guardado de un usuario (/reset); bloqueante"""
+        with self._lock:
+            conn = self._conexion()
+            with conn:
+                conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+    def replay(self) -> Iterator[tuple[str, str, str, bool]]:
+        """Devuelve (user_id, role, content, is_deep) en el orden en que se escribieron"""
+        with self._lock:
+            conn = self._conexion()
+            with conn:
+                # Compacta lo que quedara de versiones sin poda antes de leer
+                conn.execute(
+                    """
+                    DELETE FROM messages WHERE id IN (
+                        SELECT id FROM (
+                            SELECT id, ROW_NUMBER() OVER (
+                                PARTITION BY user_id ORDER BY id DESC
+                            ) AS n FROM messages
+                        ) WHERE n > ?
+                    )
+                    """,
+                    (self.max_por_usuario,)
+                )
+            cursor = conn.execute(
+                "SELECT user_id, role, content, is_deep FROM messages ORDER BY id"
+            )
+            for user_id, role, content, is_deep in cursor:
+                yield user_id, role, content, bool(is_deep)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None